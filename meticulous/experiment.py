@@ -1,13 +1,19 @@
-import sys, os, json, datetime
+import sys, os, re, json, hashlib, datetime
 from glob import glob
 from typing import Dict
 
-from meticulous.utils import Tee, ExitHooks
+from meticulous.utils import Tee, ExitHooks, CheckpointManifest
 import atexit
 import traceback
 import logging
 logger = logging.getLogger('meticulous')
 
+# numpy is only needed to store array-valued summary entries
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
@@ -29,6 +35,7 @@ class Experiment(object):
             If such an experiment exists, then checks if it exactly matches the arguments and the git sha.
             If not, throws an error.
             Otherwise, it resumes that experiment by setting it as the current experiment.
+            The original args and start-time are kept and the resume is appended to metadata['resumes'].
 
         6. Saves experiment info
         7. Redirects stdout and stderr to the experiment directory
@@ -75,6 +82,8 @@ class Experiment(object):
         self.metadata['command'] = sys.argv
 
         self.curexpdir = None
+        self.resumed = False
+        """bool: True if an existing experiment was resumed"""
 
         if experiment_id:
             self.curexpdir = os.path.join(self.experiments_directory, experiment_id)
@@ -102,6 +111,8 @@ class Experiment(object):
                             )
                         else:
                             logger.info("Args and githead-sha matches, resuming experiment")
+                            self.resumed = True
+                            self._record_resume(existing_experiment_fmetadata)
             else:
                 os.mkdir(self.curexpdir)
 
@@ -122,12 +133,16 @@ class Experiment(object):
             os.mkdir(self.curexpdir)
             logger.info("New experiment at {curexpdir}".format(curexpdir=self.curexpdir))
 
-        #Write experiment info
-        with self.open('args.json', 'w') as f:
-            json.dump(args, f, indent=4)
+        self.checkpoints = CheckpointManifest(os.path.join(self.curexpdir, 'checkpoints.jsonl'))
+        """CheckpointManifest: append-only record of the checkpoints saved by this experiment"""
+
+        #Write experiment info, a resumed experiment keeps its original args
+        if not self.resumed:
+            with self.open('args.json', 'w') as f:
+                json.dump(args, f, indent=4)
 
-        with self.open('default_args.json', 'w') as f:
-            json.dump(default_args, f, indent=4)
+            with self.open('default_args.json', 'w') as f:
+                json.dump(default_args, f, indent=4)
 
         with self.open('metadata.json', 'w') as f:
             json.dump(self.metadata, f, indent=4)
@@ -138,6 +153,18 @@ class Experiment(object):
 
         self._set_status_file()
 
+    def _record_resume(self, existing_metadata):
+        """Keep the metadata of the experiment being resumed and append a resume event to it"""
+        resume = {
+            'time': self.metadata['start-time'],
+            'command': self.metadata['command'],
+            'description': self.metadata['description'],
+            'previous-end-time': existing_metadata.get('end-time'),
+        }
+        self.metadata = dict(existing_metadata)
+        self.metadata.pop('end-time', None)
+        self.metadata['resumes'] = existing_metadata.get('resumes', []) + [resume]
+
     @staticmethod
     def add_argument_group(parser, project_directory ='', experiments_directory='experiments', experiment_id=None,
                            description='', norecord=False):
@@ -230,8 +257,15 @@ class Experiment(object):
 
         return cls(args, default_args=default_args, **meticulous_args)
 
+    SUMMARY_ARRAY_MIN_SIZE = 100
+    """int: Lists with at least these many (numeric) elements are stored as binary sidecar files like numpy arrays"""
+
     def summary(self, summary_dict: Dict):
-        """Takes a dictionary object score and (over)writes it in the experiment directory"""
+        """Takes a dictionary object score and (over)writes it in the experiment directory
+
+        Numpy arrays and long numeric lists are saved to ``summary.<key>.<hash>.npy`` files next to summary.json,
+        which only keeps a reference to them (``{"__ndarray__": filename, "dtype": ..., "shape": ...}``).
+        """
         if self.norecord:
             return
         try:
@@ -239,10 +273,91 @@ class Experiment(object):
                 summary = json.load(f)
         except FileNotFoundError:
             summary = {}
-        summary.update(summary_dict)
+        replaced = []
+        for key, value in summary_dict.items():
+            previous = summary.get(key)
+            if isinstance(previous, dict) and '__ndarray__' in previous:
+                replaced.append(previous['__ndarray__'])
+            summary[key] = self._encode_summary_value(key, value)
         with self.open('summary.json', 'w') as f:
             json.dump(summary, f, indent=4)
 
+        # Remove the sidecars of replaced arrays that no key refers to anymore
+        referenced = {v['__ndarray__'] for v in summary.values() if isinstance(v, dict) and '__ndarray__' in v}
+        for filename in set(replaced) - referenced:
+            try:
+                os.remove(os.path.join(self.curexpdir, filename))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _sidecar_filename(key):
+        """Name of the .npy file for a summary key, readable but made unique by a hash of the raw key"""
+        digest = hashlib.sha1(str(key).encode('utf-8')).hexdigest()[:10]
+        return 'summary.{key}.{digest}.npy'.format(key=re.sub(r'[^\w.-]', '_', str(key)), digest=digest)
+
+    def _encode_summary_value(self, key, value):
+        """Returns the json serializable value to store in summary.json, saving arrays as .npy sidecar files"""
+        if np is None:
+            return value
+        if isinstance(value, np.generic):
+            return value.item()
+        is_array = isinstance(value, np.ndarray)
+        if is_array or (isinstance(value, (list, tuple)) and len(value) >= self.SUMMARY_ARRAY_MIN_SIZE):
+            try:
+                array = np.asarray(value)
+            except ValueError:
+                # Ragged nested lists
+                return value
+            # Only numeric data goes to sidecars (and boolean masks given as arrays), everything else stays json
+            if array.dtype.kind not in ('biufc' if is_array else 'iufc'):
+                return array.tolist() if is_array else value
+            if array.ndim == 0:
+                return array.item()
+            filename = self._sidecar_filename(key)
+            # Write to a temporary file and rename, so that readers never map a partially written array
+            with self.open(filename + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(os.path.join(self.curexpdir, filename + '.tmp'), os.path.join(self.curexpdir, filename))
+            return {'__ndarray__': filename, 'dtype': str(array.dtype), 'shape': list(array.shape)}
+        return value
+
+    def checkpoint(self, file: str, step=None):
+        """Record a checkpoint that has been saved (e.g. with :py:func:`open`) in the checkpoint manifest
+
+        The marker stores the step, the file, its size and its checksum, and is appended to checkpoints.jsonl.
+        Call this after the checkpoint file has been completely written.
+
+        Args:
+            file: Path of the checkpoint file, relative to the experiment directory or absolute
+            step: Training step (or epoch) of the checkpoint
+
+        Returns:
+            The recorded marker (dict)
+        """
+        if self.norecord:
+            return None
+        return self.checkpoints.record(file, step=step, time=datetime.datetime.now().isoformat())
+
+    def latest_checkpoint(self, verify_checksum: bool = False):
+        """Path to the latest recorded checkpoint that is still valid, to continue a resumed experiment from
+
+        Only the tail of the checkpoint manifest is read and checkpoints are validated by their size, so this neither
+        lists nor hashes the experiment directory. Checkpoints that were truncated or deleted are skipped.
+
+        Args:
+            verify_checksum: Also verify the checksum of the checkpoint (reads the whole file)
+
+        Returns:
+            Path to the checkpoint file or None if there is no valid checkpoint.
+            The full marker (with the step) is available from ``self.checkpoints.latest()``
+        """
+        if self.norecord:
+            return None
+        marker = self.checkpoints.latest(verify_checksum)
+        if marker is None:
+            return None
+        return marker['file'] if os.path.isabs(marker['file']) else os.path.join(self.curexpdir, marker['file'])
 
     def open(self, *args, **kwargs):
         """wrapper around the function open to redirect relative paths to  experiment directory"""
@@ -4,17 +4,84 @@ from glob import glob
 import os
 import json
 import traceback
+import heapq
+from collections.abc import Mapping
+import glob as globlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 
+from meticulous.summary_utils import ColumnStats
+from meticulous.search import OutputIndex
+from meticulous.utils import CheckpointManifest
+
 # Use the deprecated import as the new one fails with Python 3.5
 try: 
     from pandas import json_normalize
 except: 
     from pandas.io.json import json_normalize
 
+class SidecarArray(object):
+    """Reference to an array-valued summary entry stored in a .npy sidecar file, memory-mapped on first load()"""
+
+    def __init__(self, path:str, dtype=None, shape=None):
+        self.path = path
+        self.dtype = dtype
+        self.shape = None if shape is None else tuple(shape)
+        self._array = None
+
+    def load(self):
+        """The memory-mapped array (a regular array if it can't be mapped), None if the file is missing"""
+        if self._array is None:
+            try:
+                self._array = np.load(self.path, mmap_mode='r')
+            except FileNotFoundError:
+                return None
+            except (ValueError, OSError):
+                # Empty arrays can't be memory-mapped, and mmap fails with ENOMEM when out of mappings
+                self._array = np.load(self.path)
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.load(), dtype=dtype)
+
+    def __repr__(self):
+        return "array(shape={shape}, dtype={dtype})".format(shape=self.shape, dtype=self.dtype)
+
+
+class Summary(Mapping):
+    """Read-only summary dict whose array-valued entries are only loaded from their sidecar files when accessed"""
+
+    def __init__(self, values:dict):
+        self._values = values
+
+    def __getitem__(self, key):
+        value = self._values[key]
+        return value.load() if isinstance(value, SidecarArray) else value
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(self._values)
+
+    def df_values(self):
+        """Plain dict of the entries with SidecarArray references in place of arrays (nothing is loaded)"""
+        return dict(self._values)
+
+
 class ExperimentReader(object):
     """Class to read an experiment folder"""
 
+    SETUP_FILES = ('metadata.json', 'args.json', 'default_args.json')
+    """Files written once when an experiment is set up (and read only once by the constructor)"""
+
+    OUTPUT_FILES = ('stdout', 'stderr')
+    """Files the experiment's output is captured in, kept open (and appended to) while it runs"""
+
     def __init__(self, curexpdir:str):
         """
         Read experiment data from curexpdir. Reads metadata.json, args.json, default_args.json, STATUS and summary.json.
@@ -25,9 +92,18 @@ class ExperimentReader(object):
         self.curexpdir = curexpdir
         """str: Path to the directory for the current experiment"""
 
+        # Modification stamps of files as they were last read, used by refresh() and setup_modified()
+        self._stamps = {filename: self._stamp(filename) for filename in self.SETUP_FILES}
+
         self.expid = self.curexpdir.split(os.sep)[-2]
         """str: experiment id"""
 
+        self.source = os.path.dirname(os.path.normpath(self.curexpdir))
+        """str: Path to the experiments directory containing this experiment"""
+
+        self.checkpoints = CheckpointManifest(os.path.join(self.curexpdir, 'checkpoints.jsonl'))
+        """CheckpointManifest: checkpoints recorded by the experiment"""
+
         # Load metadata
         self.metadata = {}
         """dict: loaded from metadata.json"""
@@ -76,8 +152,17 @@ class ExperimentReader(object):
         args = (os.path.join(self.curexpdir, args[0]),)+ args[1:]
         return open(*args, **kwargs)
 
+    def _stamp(self, filename):
+        """(mtime, size) of a file in the experiment directory, None if it doesn't exist"""
+        try:
+            st = os.stat(os.path.join(self.curexpdir, filename))
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
     def refresh_status(self):
         """Read STATUS file"""
+        self._stamps['STATUS'] = self._stamp('STATUS')
         try:
             with self.open('STATUS', 'r') as f:
                 ls = list(f)
@@ -87,12 +172,62 @@ class ExperimentReader(object):
             pass
 
     def refresh_summary(self):
-        """Read summary.json"""
+        """Read summary.json, array-valued entries are memory-mapped from their .npy sidecar files on first access"""
+        self._stamps['summary.json'] = self._stamp('summary.json')
         try:
             with self.open('summary.json', 'r') as f:
-                self.summary = json.load(f)
+                summary = json.load(f)
         except FileNotFoundError:
-            pass
+            return
+        for key, value in summary.items():
+            if isinstance(value, dict) and '__ndarray__' in value:
+                summary[key] = SidecarArray(os.path.join(self.curexpdir, value['__ndarray__']),
+                                            value.get('dtype'), value.get('shape'))
+        self.summary = Summary(summary)
+
+    def refresh(self, output:bool = False):
+        """Re-read STATUS and summary.json, but only the ones modified since they were last read
+
+        Args:
+            output: Also check whether stdout/stderr grew since the last check (they are not read)
+
+        Returns:
+            True if anything was re-read (or the output changed)
+        """
+        changed = False
+        for filename, refresh in (('STATUS', self.refresh_status), ('summary.json', self.refresh_summary)):
+            if self._stamp(filename) != self._stamps.get(filename):
+                refresh()
+                changed = True
+        if output:
+            for filename in self.OUTPUT_FILES:
+                stamp = self._stamp(filename)
+                if stamp != self._stamps.get(filename):
+                    self._stamps[filename] = stamp
+                    changed = True
+        return changed
+
+    def track_output(self):
+        """Remember the current state of stdout/stderr, so that refresh(output=True) reports only later changes"""
+        for filename in self.OUTPUT_FILES:
+            self._stamps[filename] = self._stamp(filename)
+
+    def latest_checkpoint(self, verify_checksum:bool = False):
+        """Path to the latest valid checkpoint recorded in checkpoints.jsonl, or None
+
+        Args:
+            verify_checksum: Also verify the checksum of the checkpoint (reads the whole file)
+
+        The full marker (with the step) is available from ``self.checkpoints.latest()``
+        """
+        marker = self.checkpoints.latest(verify_checksum)
+        if marker is None:
+            return None
+        return marker['file'] if os.path.isabs(marker['file']) else os.path.join(self.curexpdir, marker['file'])
+
+    def setup_modified(self):
+        """True if any of the SETUP_FILES changed since the experiment was read (e.g. it was still being created)"""
+        return any(self._stamp(filename) != self._stamps.get(filename) for filename in self.SETUP_FILES)
 
     def __repr__(self):
         return self.curexpdir
@@ -109,19 +244,28 @@ class ExperimentReader(object):
             args=self.args,
             default_args=self.default_args,
             metadata=self.metadata,
-            summary=self.summary,
+            # Sidecar arrays stay unloaded in the dataframe
+            summary=self.summary.df_values() if isinstance(self.summary, Summary) else self.summary,
         )
 
 
 class Experiments(object):
-    """Class to load an experiments folder"""
-    def __init__(self, project_directory:str = '', experiments_directory:str = None, reader = ExperimentReader):
+    """Class to load one or more experiments folders"""
+
+    MAX_READER_THREADS = 32
+    """int: Maximum number of experiments directories read concurrently"""
+
+    MAX_SEARCH_FILTER = 500
+    """int: Maximum number of experiments a search is restricted to inside the index query"""
+    def __init__(self, project_directory:str = '', experiments_directory = None, reader = ExperimentReader):
         """
         Load the repo from project_directory and experiments from expdir using ExperimentReader class.
 
         Args:
             project_directory: Path to the project directory, should be part of a git repo.
             experiments_directory: Path to the directory that stores experiments. If a relative path is specified then it is relative to the project directory. Created if it doesn't exist.
+                A list of directories and/or glob patterns can be given to load them all (concurrently) into one.
+                In that case experiment ids are namespaced as ``<directory>:<expid>``.
             reader: To allow overriding with a user defined version of ExperimentReader class.
         """
         self.project_directory = project_directory
@@ -131,39 +275,315 @@ class Experiments(object):
             self.experiments_directory = experiments_directory
         else:
             self.experiments_directory = os.path.join(self.project_directory, 'experiments')
+        self.experiments_directories = []
+        """List[str]: The experiments directories being read, after expanding glob patterns"""
         self.reader = reader
         self.experiments = {}
         """Dict[ExperimentReader]: experiment ids mapped to respective ExperimentReader objects """
+        self.args_stats = ColumnStats()
+        """ColumnStats: per-column statistics of the args of loaded experiments"""
+        self.output_indexes = {}
+        """Dict[OutputIndex]: experiments directories mapped to the index over their stdout/stderr, created on first search"""
+        self._rows = {}
+        """Dict[dict]: expids mapped to their normalized dataframe rows, by normalize_json_values"""
+        self._indexed = set()
+        """Set[str]: expids of finished experiments whose output has been indexed completely"""
         self.refresh_experiments()
 
+    @property
+    def federated(self):
+        """True if experiments are read from more than one directory (and their ids are namespaced)"""
+        return len(self.experiments_directories) > 1
+
+    def _resolve_directories(self):
+        """Expand the glob patterns in experiments_directory into a list of directories"""
+        patterns = [self.experiments_directory] if isinstance(self.experiments_directory, str) else self.experiments_directory
+        directories = []
+        for pattern in patterns:
+            matches = sorted(d for d in glob(pattern) if os.path.isdir(d)) if globlib.has_magic(pattern) else [pattern]
+            for d in matches:
+                if os.path.normpath(d) not in directories:
+                    directories.append(os.path.normpath(d))
+        return directories
+
     def refresh_experiments(self):
         """Read experiments from the file system"""
+        self.experiments_directories = self._resolve_directories()
+        self._directory_stamps = {}
+        if len(self.experiments_directories) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.MAX_READER_THREADS, len(self.experiments_directories))) as executor:
+                per_directory = list(executor.map(self._read_directory, self.experiments_directories))
+        else:
+            per_directory = [self._read_directory(d) for d in self.experiments_directories]
+
+        # Each list is already sorted, so merge them instead of sorting everything again
+        experiments = heapq.merge(*per_directory, key = lambda expReader: expReader.start_time)
+        self.experiments = {e.expid: e for e in experiments}
+        self._rows = {}
+        self._indexed = set()
+        self.args_stats = ColumnStats()
+        for e in self.experiments.values():
+            self.args_stats.add(e.args, e.default_args)
+
+    def _read_directory(self, experiments_directory):
+        """Read all experiments in one experiments directory, returns them sorted by start time"""
         experiments = []
-        print("Reading experiments from {dir}".format(dir=self.experiments_directory), file=sys.stdout)
-        for exp in glob(self.experiments_directory+'/*/'):
-            try:
-                experimentReader = self.reader(exp)
+        print("Reading experiments from {dir}".format(dir=experiments_directory), file=sys.stdout)
+        # Stamp the directory before listing it, so that experiments created meanwhile are picked up by refresh_changed
+        self._directory_stamps[experiments_directory] = self._directory_stamp(experiments_directory)
+        for exp in glob(experiments_directory+'/*/'):
+            experimentReader = self._read_experiment(exp)
+            if experimentReader is not None:
                 experiments.append(experimentReader)
-            except Exception as e:
-                print("Unable to read {exp}".format(exp=exp), file=sys.stderr)
-                traceback.print_exc(file=sys.stderr)
+        return sorted(experiments, key = lambda expReader: expReader.start_time)
+
+    @staticmethod
+    def _directory_stamp(experiments_directory):
+        return os.stat(experiments_directory).st_mtime_ns if os.path.isdir(experiments_directory) else None
+
+    def add_experiment(self, curexpdir:str):
+        """Read a single (new) experiment folder and add it, updating the column statistics incrementally
+
+        Args:
+            curexpdir: The experiment directory to read
+
+        Returns:
+            The ExperimentReader object, or None if the experiment could not be read
+        """
+        experimentReader = self._read_experiment(curexpdir)
+        if experimentReader is None:
+            return None
+        previous = self.experiments.get(experimentReader.expid)
+        if previous is not None:
+            self.args_stats.remove(previous.args, previous.default_args)
+        self.experiments[experimentReader.expid] = experimentReader
+        self._forget(experimentReader.expid)
+        self.args_stats.add(experimentReader.args, experimentReader.default_args)
+        return experimentReader
+
+    def remove_experiment(self, expid:str):
+        """Remove an experiment (e.g. whose folder was deleted), updating the column statistics incrementally
+
+        Returns:
+            The removed ExperimentReader object
+        """
+        experimentReader = self.experiments.pop(expid)
+        self._forget(expid)
+        self.args_stats.remove(experimentReader.args, experimentReader.default_args)
+        return experimentReader
+
+    def _forget(self, expid):
+        """Drop what is cached about an experiment that was added, re-read or removed"""
+        self._rows.pop(expid, None)
+        self._indexed.discard(expid)
+
+    def _read_experiment(self, curexpdir):
+        """Read curexpdir with the reader class, returns None (and prints the traceback) if it fails"""
+        try:
+            experimentReader = self.reader(curexpdir)
+            if self.federated:
+                experimentReader.expid = "{source}:{expid}".format(source=experimentReader.source, expid=experimentReader.expid)
+            return experimentReader
+        except Exception as e:
+            print("Unable to read {exp}".format(exp=curexpdir), file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return None
+
+    def refresh_changed(self, curexpdirs=None, output:bool = False):
+        """Update only the experiments that changed on the file system since they were last read
 
-        self.experiments = {e.expid: e for e in sorted(experiments, key = lambda expReader: expReader.start_time)}
+        Args:
+            curexpdirs: Experiment directories known to have changed (e.g. from file system notifications).
+                If None, the experiments directory is listed for new experiments (only if its mtime changed) and
+                the files of every loaded experiment are checked for modifications with os.stat (without reading them).
+            output: Also report experiments whose stdout/stderr changed (e.g. to recompute search columns)
 
+        Returns:
+            List of ExperimentReader objects that were added, re-read or removed (because their folder was deleted)
+        """
+        loaded = {os.path.normpath(e.curexpdir): e for e in self.experiments.values()}
+        if curexpdirs is None:
+            curexpdirs = list(loaded.keys())
+            for experiments_directory in self.experiments_directories:
+                stamp = self._directory_stamp(experiments_directory)
+                if stamp != self._directory_stamps.get(experiments_directory):
+                    self._directory_stamps[experiments_directory] = stamp
+                    curexpdirs += [exp for exp in glob(experiments_directory+'/*/') if os.path.normpath(exp) not in loaded]
+
+        changed = []
+        for exp in curexpdirs:
+            experimentReader = loaded.get(os.path.normpath(exp))
+            if not os.path.isdir(exp):
+                if experimentReader is not None and experimentReader.expid in self.experiments:
+                    changed.append(self.remove_experiment(experimentReader.expid))
+            elif experimentReader is None or experimentReader.setup_modified():
+                experimentReader = self.add_experiment(os.path.join(exp, ''))
+                if experimentReader is not None:
+                    changed.append(experimentReader)
+            elif experimentReader.refresh(output):
+                self._forget(experimentReader.expid)
+                changed.append(experimentReader)
+        return changed
+
+    def output_index(self, experiments_directory:str):
+        """The OutputIndex over stdout/stderr of the experiments in experiments_directory"""
+        if experiments_directory not in self.output_indexes:
+            self.output_indexes[experiments_directory] = OutputIndex(experiments_directory)
+        return self.output_indexes[experiments_directory]
+
+    def update_output_index(self, expids=None):
+        """Index the stdout/stderr output appended since the last update
+
+        Finished experiments that were already indexed completely are skipped until they are re-read.
 
-    def as_dataframe(self, normalize_json_values=0):
-        """Returns all experiment data as a pandas dataframe"""
-        if len(self.experiments.values()) > 0:
-            df = json_normalize([e.df_vars() for e in self.experiments.values()], max_level=1+normalize_json_values)
+        Args:
+            expids: Only update these experiments (default all)
+        """
+        experiments = self.experiments.values() if expids is None else [self.experiments[i] for i in expids]
+        for e in experiments:
+            if e.expid in self._indexed:
+                continue
+            index = self.output_index(e.source)
+            folder = os.path.basename(os.path.normpath(e.curexpdir))
+            running = e.status.startswith('RUNNING')
+            for stream in OutputIndex.STREAMS:
+                index.update(folder, stream, complete=not running)
+            if not running:
+                self._indexed.add(e.expid)
+
+    def search(self, query:str, streams=OutputIndex.STREAMS, phrase:bool = True, update:bool = True, expids=None):
+        """Search the captured stdout/stderr of all experiments using an incrementally updated index
+
+        Args:
+            query: Text to search for (case insensitive)
+            streams: Streams to search in
+            phrase: If true, lines must contain the query as is. Otherwise they must contain all of its words.
+            update: Update the index (see :py:func:`update_output_index`) before searching
+            expids: Only search the output of these experiments (default all)
+
+        Returns:
+            Dataframe of matching lines with columns expid, stream, offset (in bytes) and line
+        """
+        if update:
+            self.update_output_index(expids)
+        experiments = self.experiments.values() if expids is None else [self.experiments[i] for i in expids]
+        by_folder = {(e.source, os.path.basename(os.path.normpath(e.curexpdir))): e.expid for e in experiments}
+        matches = []
+        for experiments_directory in self.experiments_directories:
+            folders = None if expids is None else [folder for source, folder in by_folder if source == experiments_directory]
+            if folders is not None and not folders:
+                continue
+            if folders is not None and len(folders) > self.MAX_SEARCH_FILTER:
+                # Too many for an sqlite IN (...) clause, filter the matches below instead
+                folders = None
+            for folder, stream, offset, line in self.output_index(experiments_directory).search(query, streams, phrase, folders):
+                if (experiments_directory, folder) in by_folder:
+                    matches.append((by_folder[(experiments_directory, folder)], stream, offset, line))
+        return pd.DataFrame(matches, columns=['expid', 'stream', 'offset', 'line'])
+
+    def _normalize(self, experiments, normalize_json_values):
+        """Normalize the experiments' df_vars with a single json_normalize call and cache the rows
+
+        The cache keeps a reference to the normalized frame and the row's position in it. Rows are only turned into
+        dicts when they are needed without the rest of the frame (see :py:func:`_cached_rows`).
+        """
+        records = []
+        for e in experiments:
+            record = e.df_vars()
+            if self.federated:
+                record['header']['source'] = e.source
+            records.append(record)
+        flat = json_normalize(records, max_level=1+normalize_json_values)
+        for position, e in enumerate(experiments):
+            self._rows.setdefault(e.expid, {})[normalize_json_values] = (flat, position)
+        return flat
+
+    def _cached_rows(self, experiments, normalize_json_values):
+        """Cached normalized rows (flat dicts) of the experiments"""
+        rows = []
+        for e in experiments:
+            row = self._rows[e.expid][normalize_json_values]
+            if isinstance(row, tuple):
+                # Materialize all the rows still referring to that frame at once
+                flat = row[0]
+                referring = {cache[normalize_json_values][1]: cache for cache in self._rows.values()
+                             if isinstance(cache.get(normalize_json_values), tuple) and cache[normalize_json_values][0] is flat}
+                for position, flat_row in enumerate(flat.to_dict('records')):
+                    if position in referring:
+                        # Drop the NaNs filled in for columns that only other experiments have
+                        referring[position][normalize_json_values] = {k: v for k, v in flat_row.items()
+                                                                      if not (isinstance(v, float) and v != v)}
+                row = self._rows[e.expid][normalize_json_values]
+            rows.append(row)
+        return rows
+
+    def as_dataframe(self, normalize_json_values=0, search=None, expids=None):
+        """Returns all experiment data as a pandas dataframe
+
+        Args:
+            normalize_json_values: Unroll json formatted column values into separate columns, upto given levels deep
+            search: Optional list of queries, for each a ``('search', query)`` column with the number of matching
+                lines in stdout/stderr is added (see :py:func:`search`)
+            expids: Only include these experiments (default all)
+        """
+        experiments = list(self.experiments.values()) if expids is None else [self.experiments[i] for i in expids]
+        if len(experiments) > 0:
+            uncached = [e for e in experiments if normalize_json_values not in self._rows.get(e.expid, {})]
+            if len(uncached) == len(experiments):
+                # Shallow copy, so that renaming the columns below doesn't affect the cached frame
+                df = self._normalize(experiments, normalize_json_values).copy(deep=False)
+            else:
+                if uncached:
+                    self._normalize(uncached, normalize_json_values)
+                df = pd.DataFrame(self._cached_rows(experiments, normalize_json_values))
 
             df.columns = pd.MultiIndex.from_tuples(
                 [level_vals.split('.') for level_vals in
                  df.columns])
-            df = df.set_index(('header', 'expid'))
+            # Pad column keys with NaN like the columns that have fewer levels than the deepest one
+            padding = (np.nan,) * (df.columns.nlevels - 2)
+            df = df.set_index(('header', 'expid') + padding)
+            if search:
+                self.update_output_index(expids)
+            for query in search or []:
+                counts = self.search(query, update=False, expids=expids)['expid'].value_counts()
+                df[('search', query) + padding] = counts.reindex(df.index, fill_value=0).values
             return df
         else:
             raise IndexError("Unable to load any experiments")
 
+    def update_dataframe(self, df, changed, normalize_json_values=0, search=None):
+        """Update a dataframe returned by :py:func:`as_dataframe` with only the experiments that changed
+
+        Args:
+            df: The dataframe to update
+            changed: ExperimentReader objects that were added, re-read or removed (see :py:func:`refresh_changed`)
+            normalize_json_values, search: Same as for :py:func:`as_dataframe`
+
+        Returns:
+            The updated dataframe, in the same order as ``self.experiments``
+        """
+        expids = [e.expid for e in changed]
+        parts = [df.drop(index=expids, errors='ignore')]
+        present = [expid for expid in expids if expid in self.experiments]
+        if present:
+            parts.append(self.as_dataframe(normalize_json_values, search, expids=present))
+        # Nested values in the changed rows can add (or remove) column levels, bring the parts to the same depth
+        nlevels = max(part.columns.nlevels for part in parts)
+        parts = [self._pad_columns(part, nlevels) for part in parts]
+        df = pd.concat(parts)
+        df.index.name = ('header', 'expid') + (np.nan,) * (nlevels - 2)
+        return df.reindex([expid for expid in self.experiments if expid in df.index])
+
+    @staticmethod
+    def _pad_columns(df, nlevels):
+        """Pad the column keys of df with NaN up to nlevels"""
+        if df.columns.nlevels == nlevels:
+            return df
+        df = df.copy(deep=False)
+        df.columns = pd.MultiIndex.from_tuples([tuple(c) + (np.nan,) * (nlevels - len(c)) for c in df.columns])
+        return df
+
     def __getitem__(self, key):
         return self.experiments[key]
 
@@ -0,0 +1,158 @@
+import os
+import re
+import itertools
+import sqlite3
+import logging
+
+logger = logging.getLogger('meticulous')
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text: str):
+    """Lowercased word tokens of text"""
+    return TOKEN_RE.findall(text.lower())
+
+
+class OutputIndex(object):
+    """Incremental inverted index over the stdout/stderr files of the experiments in an experiments directory
+
+    Every token is mapped to the (experiment, stream, byte offset) of the lines that contain it. For each file the
+    offset up to which it has been indexed is stored, so that updating the index only reads what was appended since.
+    The index is kept in an sqlite database, by default ``.meticulous_index.sqlite`` in the experiments directory.
+    """
+
+    STREAMS = ('stdout', 'stderr')
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, experiments_directory: str, index_path: str = None):
+        """
+        Args:
+            experiments_directory: The experiments directory whose experiments are indexed
+            index_path: Path to the sqlite database. If it can't be opened the index is kept in memory.
+        """
+        self.experiments_directory = experiments_directory
+        self.index_path = index_path or os.path.join(experiments_directory, '.meticulous_index.sqlite')
+        try:
+            self.db = sqlite3.connect(self.index_path)
+            self._create_tables()
+        except sqlite3.Error:
+            logger.warning("Unable to open {path}, keeping the output index in memory".format(path=self.index_path))
+            self.db = sqlite3.connect(':memory:')
+            self._create_tables()
+        self.offsets = {(expid, stream): offset for expid, stream, offset in self.db.execute('SELECT * FROM files')}
+        """Dict[int]: (expid, stream) mapped to the byte offset up to which it has been indexed"""
+
+    def _create_tables(self):
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files ('
+                            'expid TEXT, stream TEXT, offset INTEGER, PRIMARY KEY (expid, stream))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS postings ('
+                            'token TEXT, expid TEXT, stream TEXT, line_offset INTEGER, '
+                            'PRIMARY KEY (token, expid, stream, line_offset)) WITHOUT ROWID')
+            self.db.execute('CREATE INDEX IF NOT EXISTS postings_file ON postings (expid, stream)')
+
+    def _path(self, expid, stream):
+        return os.path.join(self.experiments_directory, expid, stream)
+
+    def indexed_offset(self, expid: str, stream: str):
+        """Byte offset up to which expid/stream has been indexed"""
+        return self.offsets.get((expid, stream), 0)
+
+    def update(self, expid: str, stream: str, complete: bool = False):
+        """Index the lines appended to expid/stream since the last update
+
+        Args:
+            expid: Name of the experiment folder
+            stream: stdout or stderr
+            complete: If true, a trailing line without a newline is indexed as well (the experiment is not running).
+                Otherwise it is left for a later update, when it has been written completely.
+
+        Returns:
+            Number of bytes indexed
+        """
+        path = self._path(expid, stream)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        offset = self.indexed_offset(expid, stream)
+        if size == offset:
+            return 0
+
+        with self.db:
+            if size < offset:
+                # The file was truncated or rewritten, start over
+                self.db.execute('DELETE FROM postings WHERE expid=? AND stream=?', (expid, stream))
+                offset = 0
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                pending = b''
+                line_offset = offset
+                while True:
+                    chunk = f.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines = (pending + chunk).split(b'\n')
+                    pending = lines.pop()
+                    line_offset = self._add_lines(expid, stream, lines, line_offset)
+                if complete and pending:
+                    line_offset = self._add_lines(expid, stream, [pending], line_offset) - 1
+            self.db.execute('INSERT OR REPLACE INTO files (expid, stream, offset) VALUES (?, ?, ?)',
+                            (expid, stream, line_offset))
+        self.offsets[(expid, stream)] = line_offset
+        return line_offset - offset
+
+    def _add_lines(self, expid, stream, lines, line_offset):
+        """Add postings for the lines starting at line_offset, returns the offset after the last line"""
+        postings = []
+        for line in lines:
+            for token in set(tokenize(line.decode('utf-8', errors='replace'))):
+                postings.append((token, expid, stream, line_offset))
+            line_offset += len(line) + 1
+        self.db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?, ?, ?)', postings)
+        return line_offset
+
+    def _read_lines(self, expid, stream, line_offsets):
+        """Yield (line_offset, line) for the lines starting at line_offsets, opening the file only once"""
+        with open(self._path(expid, stream), 'rb') as f:
+            for line_offset in line_offsets:
+                f.seek(line_offset)
+                yield line_offset, f.readline().rstrip(b'\n').decode('utf-8', errors='replace')
+
+    def search(self, query: str, streams=STREAMS, phrase: bool = True, expids=None):
+        """Find the lines matching query
+
+        Args:
+            query: Text to search for (case insensitive)
+            streams: Streams to search in
+            phrase: If true, lines must contain the query as is. Otherwise they must contain all of its tokens.
+            expids: Only search the output of these experiment folders (default all)
+
+        Returns:
+            List of (expid, stream, line_offset, line) tuples
+        """
+        tokens = sorted(set(tokenize(query)))
+        if not tokens or (expids is not None and not expids):
+            return []
+        condition = 'token=? AND stream IN ({p})'.format(p=','.join('?' * len(streams)))
+        filters = tuple(streams)
+        if expids is not None:
+            condition += ' AND expid IN ({p})'.format(p=','.join('?' * len(expids)))
+            filters += tuple(expids)
+        candidates = ' INTERSECT '.join(['SELECT expid, stream, line_offset FROM postings WHERE ' + condition] * len(tokens))
+        params = [p for token in tokens for p in (token,) + filters]
+        matches = []
+        rows = self.db.execute(candidates + ' ORDER BY 1, 2, 3', params)
+        for (expid, stream), group in itertools.groupby(rows, key=lambda row: row[:2]):
+            try:
+                for line_offset, line in self._read_lines(expid, stream, [row[2] for row in group]):
+                    if phrase and query.lower() not in line.lower():
+                        continue
+                    matches.append((expid, stream, line_offset, line))
+            except OSError:
+                continue
+        return matches
+
+    def close(self):
+        self.db.close()
@@ -1,7 +1,87 @@
+import json
+from collections import Counter
+
 import pandas as pd
 
-def informative_cols(dataframe):
-    return [c for c, v in dataframe.nunique(dropna=False).iteritems() if v > 1]
+def informative_cols(dataframe, stats=None):
+    """Columns of dataframe whose values are not constant across rows
+
+    Args:
+        dataframe: Dataframe to inspect
+        stats: Optional ColumnStats maintained over the same rows, used instead of scanning the dataframe
+    """
+    if stats is not None:
+        informative = set(stats.informative_cols())
+        return [c for c in dataframe.columns if c in informative]
+    return [c for c, v in dataframe.nunique(dropna=False).items() if v > 1]
+
+def truncate_constant_cols(dataframe, stats=None):
+    return dataframe[informative_cols(dataframe, stats)]
+
+
+class ColumnStats(object):
+    """Per-column statistics over a set of flat dicts (e.g. experiment args), updated one row at a time
+
+    For every column it keeps the number of rows containing it, a count of each distinct value and the number of rows
+    where the value differs from the supplied default. This is enough to answer ``informative_cols`` and
+    non-default queries without scanning all the rows again.
+    """
+
+    def __init__(self):
+        self.n_rows = 0
+        """int: Number of rows added so far"""
+        self.present = Counter()
+        """Counter: column mapped to the number of rows that contain it with a non-missing value"""
+        self.values = {}
+        """Dict[Counter]: column mapped to the counts of its (json encoded) values"""
+        self.non_default = Counter()
+        """Counter: column mapped to the number of rows where the value differs from the default"""
+
+    @staticmethod
+    def _is_missing(value):
+        """None (json null) and NaN are missing values, like in the dataframe"""
+        return value is None or (isinstance(value, float) and value != value)
+
+    @staticmethod
+    def _key(value):
+        """Hashable representation of a json value, numbers that compare equal (e.g. 1 and 1.0) get the same key"""
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        try:
+            return json.dumps(value, sort_keys=True)
+        except (TypeError, ValueError):
+            return repr(value)
+
+    def _update(self, row, defaults, sign):
+        defaults = defaults or {}
+        self.n_rows += sign
+        for col, value in row.items():
+            counts = self.values.setdefault(col, Counter())
+            if not self._is_missing(value):
+                self.present[col] += sign
+                counts[self._key(value)] += sign
+            if col not in defaults or defaults[col] != value:
+                self.non_default[col] += sign
+
+    def add(self, row, defaults=None):
+        """Add a row (dict of column to value) along with its defaults"""
+        self._update(row, defaults, 1)
+
+    def remove(self, row, defaults=None):
+        """Remove a row previously added with the same row and defaults"""
+        self._update(row, defaults, -1)
+
+    def nunique(self, col):
+        """Number of distinct values in col, counting a missing value as one of them (like ``nunique(dropna=False)``)"""
+        distinct = sum(1 for count in self.values.get(col, {}).values() if count > 0)
+        if self.present[col] < self.n_rows:
+            distinct += 1
+        return distinct
+
+    def informative_cols(self):
+        """Columns that take more than one value across the rows"""
+        return [col for col in self.values if self.nunique(col) > 1]
 
-def truncate_constant_cols(dataframe):
-    return dataframe[informative_cols(dataframe)]
\ No newline at end of file
+    def non_default_cols(self):
+        """Columns that differ from their default value in at least one row"""
+        return [col for col, count in self.non_default.items() if count > 0]
@@ -1,4 +1,4 @@
-import sys
+import sys, os, json, hashlib
 class ExitHooks(object):
     def __init__(self):
         self.exited = False
@@ -67,3 +67,106 @@ class Tee(object):
 
     def getvalue(self):
         return self.stdstream.getvalue()
+
+
+class CheckpointManifest(object):
+    """
+    Append-only manifest of checkpoint markers, one json object per line.
+
+    Each marker records the step, the checkpoint file (relative to the manifest's directory), its size and sha256
+    checksum. The latest valid checkpoint is found by reading the manifest backwards from its end and comparing sizes,
+    without listing the directory or hashing any checkpoint.
+    """
+    BLOCK_SIZE = 4096
+
+    def __init__(self, path):
+        """
+        :param path: path to the manifest file, checkpoint files are resolved relative to its directory
+        """
+        self.path = path
+        self.directory = os.path.dirname(path)
+
+    @staticmethod
+    def checksum(path):
+        """sha256 hex digest of a file"""
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def append(self, marker):
+        """Append a marker (dict) and make sure it reaches the disk"""
+        with open(self.path, 'a+b') as f:
+            line = (json.dumps(marker) + '\n').encode('utf-8')
+            # Start on a new line if the previous write was torn (e.g. the node was preempted)
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, file, step=None, **extra):
+        """Create a marker for an existing checkpoint file and append it
+
+        :param file: path of the checkpoint, relative to the manifest's directory or absolute
+        :param step: training step (or epoch) of the checkpoint
+        :return: the marker
+        """
+        path = file if os.path.isabs(file) else os.path.join(self.directory, file)
+        marker = dict(step=step, file=file, size=os.path.getsize(path), sha256=self.checksum(path), **extra)
+        self.append(marker)
+        return marker
+
+    def reversed_markers(self):
+        """Yield the markers from the last to the first, skipping lines that are not valid json (e.g. a torn write)"""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            position = f.seek(0, os.SEEK_END)
+            remainder = b''
+            while position > 0:
+                read_size = min(self.BLOCK_SIZE, position)
+                position -= read_size
+                f.seek(position)
+                lines = (f.read(read_size) + remainder).split(b'\n')
+                # The first line may be incomplete unless we are at the start of the file
+                remainder = lines.pop(0) if position > 0 else b''
+                for line in reversed(lines):
+                    marker = self._parse(line)
+                    if marker is not None:
+                        yield marker
+            marker = self._parse(remainder)
+            if marker is not None:
+                yield marker
+
+    @staticmethod
+    def _parse(line):
+        if not line.strip():
+            return None
+        try:
+            return json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def is_valid(self, marker, verify_checksum=False):
+        """Whether the checkpoint file of marker still exists with the recorded size (and checksum if asked)"""
+        path = marker['file'] if os.path.isabs(marker['file']) else os.path.join(self.directory, marker['file'])
+        try:
+            if os.path.getsize(path) != marker['size']:
+                return False
+        except (OSError, KeyError):
+            return False
+        return not verify_checksum or self.checksum(path) == marker.get('sha256')
+
+    def latest(self, verify_checksum=False):
+        """The latest marker whose checkpoint file is valid, or None"""
+        for marker in self.reversed_markers():
+            if self.is_valid(marker, verify_checksum):
+                return marker
+        return None
+
@@ -0,0 +1,107 @@
+import os
+import time
+import logging
+
+# inotify is optional (and Linux only), fall back to polling file modification times without it
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+logger = logging.getLogger('meticulous')
+
+
+class ExperimentsWatcher(object):
+    """Waits for changes to the experiments directories and applies them to a resident Experiments object
+
+    Uses inotify (through the optional ``inotify_simple`` package) when available, so that only the experiment folders
+    that were written to get re-read. Otherwise it polls every ``interval`` seconds and lets
+    :py:func:`Experiments.refresh_changed <meticulous.experiments.Experiments.refresh_changed>` check modification times.
+    """
+
+    # Files written by Experiment when it creates, updates or finishes an experiment
+    EXPERIMENT_FLAGS = ('CLOSE_WRITE', 'MOVED_TO', 'CREATE', 'DELETE')
+    # stdout/stderr stay open while the experiment runs, their writes only show up as modifications
+    OUTPUT_FLAGS = ('MODIFY',)
+
+    def __init__(self, experiments, interval: float = 2.0, use_inotify: bool = True, watch_output: bool = False):
+        """
+        Args:
+            experiments: An Experiments object to keep up to date
+            interval: Seconds to wait between polls (or the maximum time to wait for an inotify event)
+            use_inotify: If false, always poll even if inotify is available
+            watch_output: Also report experiments whose stdout/stderr changed (needed to keep search columns current)
+        """
+        self.experiments = experiments
+        self.interval = interval
+        self.watch_output = watch_output
+        if watch_output:
+            for e in self.experiments.experiments.values():
+                e.track_output()
+        self.inotify = None
+        self._watched = {}
+        """Dict[int, str]: inotify watch descriptors mapped to the watched directory"""
+        if use_inotify and INotify is not None:
+            try:
+                self.inotify = INotify()
+                for experiments_directory in self.experiments.experiments_directories:
+                    self._watch(experiments_directory)
+                for e in self.experiments.experiments.values():
+                    self._watch(e.curexpdir)
+            except OSError:
+                logger.warning("Unable to set up inotify, falling back to polling")
+                self.inotify = None
+        logger.debug("Watching {dirs} using {method}".format(dirs=', '.join(self.experiments.experiments_directories),
+                                                             method='inotify' if self.inotify else 'polling'))
+
+    def _watch(self, directory):
+        directory = os.path.normpath(directory)
+        if directory in self.experiments.experiments_directories:
+            mask = flags.CREATE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM | flags.ONLYDIR
+        else:
+            mask = 0
+            for flag in self.EXPERIMENT_FLAGS + (self.OUTPUT_FLAGS if self.watch_output else ()):
+                mask |= getattr(flags, flag)
+        wd = self.inotify.add_watch(directory, mask)
+        self._watched[wd] = directory
+
+    def wait(self):
+        """Block until something changes (or the poll interval passes) and refresh the affected experiments
+
+        Returns:
+            List of ExperimentReader objects that were added or re-read
+        """
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return self.experiments.refresh_changed(output=self.watch_output)
+
+        events = self.inotify.read(timeout=int(self.interval * 1000))
+        if not events:
+            return []
+        # Let a burst of writes (e.g. summary.json followed by STATUS) settle before reading
+        time.sleep(0.05)
+        events += self.inotify.read(timeout=0)
+
+        changed = set()
+        for event in events:
+            directory = self._watched.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                # The watched directory was deleted
+                del self._watched[event.wd]
+                changed.add(directory)
+            elif directory in self.experiments.experiments_directories:
+                # An experiment folder was created, moved in, deleted or moved out
+                experiment_directory = os.path.join(directory, event.name)
+                if os.path.isdir(experiment_directory) and experiment_directory not in self._watched.values():
+                    self._watch(experiment_directory)
+                changed.add(experiment_directory)
+            else:
+                changed.add(directory)
+        return self.experiments.refresh_changed(sorted(changed), output=self.watch_output)
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None